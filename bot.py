@@ -5,11 +5,21 @@ ImageBot — чат-бот для обработки изображений че
 """
 
 import asyncio
+import atexit
+import concurrent.futures
+import functools
+import hashlib
+import io
 import logging
+import logging.handlers
 import os
+import queue
 import sys
 import tempfile
+import threading
+from collections import OrderedDict
 from pathlib import Path
+from types import MappingProxyType, SimpleNamespace
 
 from dotenv import load_dotenv
 
@@ -19,29 +29,38 @@ from rag_store import DATA_DIR, RAGStore, load_document
 load_dotenv()
 
 # ANSI-цвета для уровней логирования
-_COLORS = {
+_COLORS = MappingProxyType({
     logging.DEBUG: "\033[36m",    # cyan
     logging.INFO: "\033[32m",    # green
     logging.WARNING: "\033[33m", # yellow
     logging.ERROR: "\033[31m",   # red
     logging.CRITICAL: "\033[35m\033[1m",  # bold magenta
-}
+})
 _RESET = "\033[0m"
+_STDERR_IS_TTY = sys.stderr.isatty()
 
 
 class ColoredFormatter(logging.Formatter):
     """Форматтер с выделением уровней цветом (только для TTY)."""
 
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # Готовые цветные levelname с padding из %(levelname)-8s (escape-коды не занимают ширину)
+        self._colored = {}
+        for lvl, color in _COLORS.items():
+            name = logging.getLevelName(lvl)
+            self._colored[lvl] = f"{color}{name}{_RESET}{' ' * (8 - len(name))}"
+
     def format(self, record: logging.LogRecord) -> str:
-        msg = super().format(record)
-        if sys.stderr.isatty() and record.levelno in _COLORS:
-            color = _COLORS[record.levelno]
-            levelname = record.levelname
-            spaces = 8 - len(levelname)  # padding из %(levelname)-8s
-            old = f"| {levelname}{' ' * spaces}"
-            new = f"| {color}{levelname}{_RESET}{' ' * spaces}"
-            msg = msg.replace(old, new, 1)
-        return msg
+        colored = self._colored.get(record.levelno) if _STDERR_IS_TTY else None
+        if colored is None:
+            return super().format(record)
+        levelname = record.levelname
+        record.levelname = colored
+        try:
+            return super().format(record)
+        finally:
+            record.levelname = levelname
 
 
 # Настройка логирования
@@ -61,9 +80,16 @@ root = logging.getLogger()
 root.handlers.clear()
 root.setLevel(getattr(logging, LOG_LEVEL, logging.INFO))
 if _LOG_CONSOLE:
+    # Форматирование и запись в stderr — в отдельном потоке, event loop только кладёт в очередь
+    _log_queue = queue.SimpleQueue()
+    root.addHandler(logging.handlers.QueueHandler(_log_queue))
     _handler = logging.StreamHandler(sys.stderr)
     _handler.setFormatter(ColoredFormatter(LOG_FORMAT, datefmt=LOG_DATEFMT))
-    root.addHandler(_handler)
+    _log_listener = logging.handlers.QueueListener(
+        _log_queue, _handler, respect_handler_level=True
+    )
+    _log_listener.start()
+    atexit.register(_log_listener.stop)
 else:
     root.addHandler(logging.NullHandler())
 
@@ -72,19 +98,175 @@ logger = logging.getLogger(__name__)
 logging.getLogger("telegram").setLevel(logging.WARNING)
 
 
+# Настройки Telegram-бота
+DEFAULT_MODEL = "gpt-image-1.5"
+MODELS = MappingProxyType({
+    "gpt-5.2": "gpt-5.2",
+    "gpt-image-1": "gpt-image-1",
+    "gpt-image-1.5": "gpt-image-1.5",
+    "dall-e-2": "dall-e-2",
+    "create": "create",  # text-to-image, gpt-image-1.5
+    "dalle_create": "dalle_create",  # text-to-image, DALL-E 2
+    "rag_text": "rag_text",  # RAG: ответы с контекстом из документов
+})
+MODEL_LABELS = MappingProxyType({
+    "gpt-image-1": "gpt-image-1",
+    "gpt-image-1.5": "gpt-image-1.5",
+    "dall-e-2": "DALL-E 2",
+    "create": "gpt-image-1.5 (create)",
+    "dalle_create": "DALL-E 2 (create)",
+    "rag_text": "RAG",
+})
+CREATE_MODELS = MappingProxyType({"create": "gpt-image-1.5", "dalle_create": "dall-e-2"})
+
+TELEGRAM_MAX_MESSAGE = 4000  # лимит Telegram 4096, 4000 для совместимости
+CHAT_HISTORY_SIZE = 20  # последних сообщений (user+assistant) для контекста
+RAG_ALLOWED_EXTENSIONS = (".txt", ".pdf", ".xlsx", ".xls", ".docx", ".md", ".text")
+TEXT_CONTEXT_EXTENSIONS = (".txt", ".pdf", ".xlsx", ".xls", ".docx", ".md", ".text")
+MEDIA_GROUP_DELAY = 2  # сек — ждём все фото альбома
+MEDIA_GROUP_DOWNLOADS = 5  # одновременных загрузок фото альбома
+# Устаревшие ключи user_data, удаляемые при загрузке persistence
+# (pending_images — байты фото в ожидании, старые версии хранили их в user_data)
+TRANSIENT_USER_DATA_KEYS = frozenset({"pending_images"})
+PENDING_IMAGES_TTL = 30 * 60  # сек — забытые фото в ожидании команды удаляются
+
+# Сильные ссылки на фоновые задачи, чтобы их не собрал GC до завершения
+_BG_TASKS: set[asyncio.Task] = set()
+
+
+def _on_background_done(task: asyncio.Task) -> None:
+    _BG_TASKS.discard(task)
+    if not task.cancelled() and task.exception() is not None:
+        logger.error("Ошибка фоновой задачи %s", task.get_name(), exc_info=task.exception())
+
+
+def _spawn_background(coro) -> asyncio.Task:
+    """Запускает корутину как фоновую задачу с логированием ошибок."""
+    task = asyncio.create_task(coro)
+    _BG_TASKS.add(task)
+    task.add_done_callback(_on_background_done)
+    return task
+
+
+# Фото в ожидании текстовой команды: user_id -> изображения.
+# Только в памяти процесса, в persistence не попадают.
+_PENDING: dict[int, list[bytes | bytearray]] = {}
+_PENDING_EXPIRY: dict[int, asyncio.TimerHandle] = {}
+
+
+def _get_pending(user_id: int) -> list[bytes | bytearray]:
+    """Возвращает фото пользователя, ожидающие команды."""
+    return _PENDING.get(user_id, [])
+
+
+def _expire_pending(user_id: int) -> None:
+    _PENDING.pop(user_id, None)
+    _PENDING_EXPIRY.pop(user_id, None)
+
+
+def _set_pending(user_id: int, images: list[bytes | bytearray]) -> None:
+    """Сохраняет фото в ожидании команды (пустой список — очистка), перезапускает TTL."""
+    handle = _PENDING_EXPIRY.pop(user_id, None)
+    if handle:
+        handle.cancel()
+    if not images:
+        _PENDING.pop(user_id, None)
+        return
+    _PENDING[user_id] = images
+    _PENDING_EXPIRY[user_id] = asyncio.get_running_loop().call_later(
+        PENDING_IMAGES_TTL, _expire_pending, user_id
+    )
+
+
+# Отдельный ограниченный пул для генерации изображений (минуты на вызов),
+# чтобы она не занимала весь default executor asyncio; чат идёт через to_thread
+IMAGE_WORKERS = int(os.environ.get("IMAGE_WORKERS", "4"))
+_IMAGE_EXECUTOR = concurrent.futures.ThreadPoolExecutor(
+    max_workers=IMAGE_WORKERS, thread_name_prefix="img"
+)
+atexit.register(_IMAGE_EXECUTOR.shutdown, wait=False)
+
+
+async def _run_in_image_executor(func, *args, **kwargs):
+    """Выполняет блокирующую генерацию изображения в пуле _IMAGE_EXECUTOR."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(
+        _IMAGE_EXECUTOR, functools.partial(func, *args, **kwargs)
+    )
+
+
+# LRU-кэш результатов генерации: ключ (модель, prompt, хэши изображений) -> (байты, usage).
+# Вытеснение по суммарному размеру картинок: PNG 1536x1024 весит 2–3 МБ
+IMAGE_CACHE_MB = int(os.environ.get("IMAGE_CACHE_MB", "256"))  # 0 — кэш выключен
+_IMAGE_CACHE_MAX_BYTES = IMAGE_CACHE_MB * 1024 * 1024
+_IMAGE_CACHE: OrderedDict[bytes, tuple[bytes, str | None]] = OrderedDict()
+_IMAGE_CACHE_BYTES = 0
+_IMAGE_CACHE_LOCK = threading.Lock()
+IMAGE_CACHE_HIT_NOTE = (
+    "Результат из кэша, токены не потрачены. "
+    "Измените запрос, чтобы получить новый вариант."
+)
+
+
+def _image_cache_key(model: str, prompt: str, images: list[bytes | bytearray]) -> bytes:
+    """Ключ кэша: blake2b от модели, prompt и дайджестов изображений."""
+    h = hashlib.blake2b(digest_size=16)
+    h.update(model.encode())
+    h.update(b"\0")
+    h.update(prompt.encode())
+    for img in images:
+        h.update(hashlib.blake2b(img, digest_size=16).digest())
+    return h.digest()
+
+
+def _cached_image_call(call, model: str, prompt: str, images: list[bytes | bytearray] = ()):
+    """
+    Выполняет call() (processor.process/process_create) с кэшированием результата.
+    Вызывается в _IMAGE_EXECUTOR: хэширование изображений тоже не блокирует event loop.
+    Ошибки не кэшируются. При попадании в кэш вместо usage — пометка IMAGE_CACHE_HIT_NOTE.
+    """
+    global _IMAGE_CACHE_BYTES
+    if _IMAGE_CACHE_MAX_BYTES <= 0:
+        return call()
+    key = _image_cache_key(model, prompt, images)
+    with _IMAGE_CACHE_LOCK:
+        cached = _IMAGE_CACHE.get(key)
+        if cached is not None:
+            _IMAGE_CACHE.move_to_end(key)
+            logger.info("Результат генерации взят из кэша (model=%s)", model)
+            return cached[0], IMAGE_CACHE_HIT_NOTE
+    result = call()
+    size = len(result[0])
+    if size > _IMAGE_CACHE_MAX_BYTES:
+        return result
+    with _IMAGE_CACHE_LOCK:
+        old = _IMAGE_CACHE.pop(key, None)
+        if old is not None:
+            _IMAGE_CACHE_BYTES -= len(old[0])
+        _IMAGE_CACHE[key] = result
+        _IMAGE_CACHE_BYTES += size
+        while _IMAGE_CACHE_BYTES > _IMAGE_CACHE_MAX_BYTES:
+            _, evicted = _IMAGE_CACHE.popitem(last=False)
+            _IMAGE_CACHE_BYTES -= len(evicted[0])
+    return result
+
+
 def run_telegram_bot():
     """Запуск Telegram-бота."""
     logger.info("Запуск Telegram-бота...")
 
     try:
         from telegram import Update
+        from telegram.error import RetryAfter
         from telegram.ext import (
             Application,
+            BaseRateLimiter,
             CommandHandler,
             ContextTypes,
             MessageHandler,
             filters,
             PicklePersistence,
+            PersistenceInput,
         )
     except ImportError:
         logger.error("Модуль python-telegram-bot не установлен")
@@ -101,20 +283,66 @@ def run_telegram_bot():
         )
         sys.exit(1)
 
+    # uvloop — более быстрый event loop (нет под Windows, там остаётся стандартный)
+    try:
+        import uvloop
+    except ImportError:
+        logger.debug("uvloop не установлен, используется стандартный event loop")
+    else:
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+        logger.debug("Используется uvloop")
+
+    class SemaphoreRateLimiter(BaseRateLimiter):
+        """Ограничивает число одновременных запросов к Bot API, повторяет запрос после RetryAfter."""
+
+        def __init__(self, max_concurrent: int = 25, max_retries: int = 2):
+            self._max_concurrent = max_concurrent
+            self._max_retries = max_retries
+            self._semaphore: asyncio.Semaphore | None = None
+
+        async def initialize(self) -> None:
+            self._semaphore = asyncio.Semaphore(self._max_concurrent)
+
+        async def shutdown(self) -> None:
+            pass
+
+        async def process_request(
+            self, callback, args, kwargs, endpoint, data, rate_limit_args
+        ):
+            # Пауза после RetryAfter выполняется под семафором — остальные запросы притормаживают
+            async with self._semaphore:
+                for attempt in range(self._max_retries + 1):
+                    try:
+                        return await callback(*args, **kwargs)
+                    except RetryAfter as e:
+                        if attempt >= self._max_retries:
+                            raise
+                        delay = e.retry_after
+                        if hasattr(delay, "total_seconds"):
+                            delay = delay.total_seconds()
+                        logger.warning(
+                            "Flood control Telegram (%s): повтор через %s сек", endpoint, delay
+                        )
+                        await asyncio.sleep(delay)
+
+    class SlimPicklePersistence(PicklePersistence):
+        """
+        Миграция со старых версий: фото в ожидании раньше лежали в user_data.
+        При загрузке убираем их и из памяти приложения, и из данных persistence,
+        чтобы байты не висели в процессе и не попадали в следующий дамп.
+        """
+
+        async def get_user_data(self) -> dict:
+            data = await super().get_user_data()
+            for loaded in (data, self.user_data or {}):
+                for user_data in loaded.values():
+                    for key in TRANSIENT_USER_DATA_KEYS:
+                        user_data.pop(key, None)
+            return data
+
     logger.info("Токен загружен, инициализация процессора изображений")
     processor = ImageProcessor()
 
-    DEFAULT_MODEL = "gpt-image-1.5"
-    MODELS = {
-        "gpt-5.2": "gpt-5.2",
-        "gpt-image-1": "gpt-image-1",
-        "gpt-image-1.5": "gpt-image-1.5",
-        "dall-e-2": "dall-e-2",
-        "create": "create",  # text-to-image, gpt-image-1.5
-        "dalle_create": "dalle_create",  # text-to-image, DALL-E 2
-        "rag_text": "rag_text",  # RAG: ответы с контекстом из документов
-    }
-
     def set_model(context: ContextTypes.DEFAULT_TYPE, model: str) -> str:
         """Устанавливает модель для пользователя. Возвращает имя модели."""
         context.user_data["model"] = model
@@ -138,25 +366,20 @@ def run_telegram_bot():
             "/help — полная справка по всем командам"
         )
 
-    MODEL_LABELS = {
-        "gpt-image-1": "gpt-image-1",
-        "gpt-image-1.5": "gpt-image-1.5",
-        "dall-e-2": "DALL-E 2",
-        "create": "gpt-image-1.5 (create)",
-        "dalle_create": "DALL-E 2 (create)",
-        "rag_text": "RAG",
-    }
-
-    def _format_image_error(exc: Exception) -> str:
-        """Форматирует ошибки генерации изображений для пользователя."""
+    def _image_error_code(exc: Exception) -> str | None:
+        """Код ошибки OpenAI из body/code; str(exc) разбирается только если кода нет."""
         code = None
-        if hasattr(exc, "body") and isinstance(exc.body, dict):
-            err = exc.body.get("error") or exc.body
+        body = getattr(exc, "body", None)
+        if isinstance(body, dict):
+            err = body.get("error") or body
             code = err.get("code") if isinstance(err, dict) else None
-        if hasattr(exc, "code"):
-            code = code or getattr(exc, "code", None)
+        code = code or getattr(exc, "code", None)
         if not code and "moderation_blocked" in str(exc):
             code = "moderation_blocked"
+        return code
+
+    def _format_image_error(exc: Exception, code: str | None) -> str:
+        """Форматирует ошибки генерации изображений для пользователя."""
         if code == "moderation_blocked":
             return (
                 "⚠️ Запрос отклонён системой безопасности OpenAI.\n\n"
@@ -204,9 +427,6 @@ def run_telegram_bot():
             "Модель: DALL-E 2 (до 1000 символов)"
         )
 
-    TELEGRAM_MAX_MESSAGE = 4000  # лимит Telegram 4096, 4000 для совместимости
-    CHAT_HISTORY_SIZE = 20  # последних сообщений (user+assistant) для контекста
-
     def _update_chat_history(
         user_data: dict, key: str, user_msg: str, assistant_msg: str
     ) -> None:
@@ -254,14 +474,17 @@ def run_telegram_bot():
             "/help — Эта справка."
         )
 
-    RAG_ALLOWED_EXTENSIONS = (".txt", ".pdf", ".xlsx", ".xls", ".docx", ".md", ".text")
-    TEXT_CONTEXT_EXTENSIONS = (".txt", ".pdf", ".xlsx", ".xls", ".docx", ".md", ".text")
+    # Один RAGStore на процесс: общий манифест и кэш эмбеддингов запросов
+    rag_stores: dict[str, RAGStore] = {}
 
     def _get_rag_store():
         api_key = os.environ.get("OPENAI_API_KEY")
         if not api_key:
             raise ValueError("OPENAI_API_KEY не задан (нужен для эмбеддингов)")
-        return RAGStore(api_key=api_key)
+        store = rag_stores.get(api_key)
+        if store is None:
+            store = rag_stores[api_key] = RAGStore(api_key=api_key)
+        return store
 
     async def cmd_rag_add(update: Update, context: ContextTypes.DEFAULT_TYPE):
         context.user_data["rag_add_mode"] = True
@@ -468,18 +691,17 @@ def run_telegram_bot():
             "В режиме /text документ станет контекстом для вопросов."
         )
 
-    MEDIA_GROUP_DELAY = 2  # сек — ждём все фото альбома
-    media_groups: dict[str, dict] = {}  # media_group_id -> {file_ids, caption, first_update, user_id}
+    # Альбомы в сборке: bot_data["media_groups"][media_group_id] ->
+    # {file_ids, caption, first_update, user_id}. bot_data не сохраняется в persistence.
 
-    async def process_media_group_after_delay(
-        group_id: str, bot, application
-    ):
-        """Обработка собранного альбома после задержки (без JobQueue)."""
-        await asyncio.sleep(MEDIA_GROUP_DELAY)
-        data = media_groups.pop(group_id, None)
-        if not data:
-            return
+    def _flush_media_group(group_id: str, bot, application) -> None:
+        """Срабатывает по таймеру: забирает альбом из bot_data и запускает обработку."""
+        data = application.bot_data.get("media_groups", {}).pop(group_id, None)
+        if data:
+            _spawn_background(_process_media_group(data, bot, application))
 
+    async def _process_media_group(data: dict, bot, application):
+        """Обрабатывает собранный альбом: скачивает фото, выполняет подпись или ждёт команду."""
         file_ids = data["file_ids"]
         caption = data.get("caption", "")
         first_update = data["first_update"]
@@ -488,20 +710,15 @@ def run_telegram_bot():
         model = user_data.get("model", DEFAULT_MODEL)
 
         if model == "rag_text":
-            user_data["pending_images"] = []
+            _set_pending(user_id, [])
             await first_update.message.reply_text("В режиме RAG отправляйте только текстовые вопросы.")
             return
 
         # Режимы create/dalle_create: только caption, фото не скачиваем
         if model in ("create", "dalle_create"):
-            user_data["pending_images"] = []
+            _set_pending(user_id, [])
             if caption:
-                class Ctx:
-                    pass
-                ctx = Ctx()
-                ctx.bot = bot
-                ctx.application = application
-                ctx.user_data = user_data
+                ctx = SimpleNamespace(bot=bot, application=application, user_data=user_data)
                 await process_and_reply(first_update, ctx, [], caption)
             else:
                 mode_name = "DALL-E Gen" if model == "dalle_create" else "Create"
@@ -516,12 +733,19 @@ def run_telegram_bot():
             user_id,
         )
 
-        images: list[bytes] = []
-        for fid in file_ids:
-            f = await bot.get_file(fid)
-            images.append(bytes(await f.download_as_bytearray()))
+        # Скачиваем фото альбома параллельно, ограничивая число одновременных запросов
+        download_sem = asyncio.Semaphore(MEDIA_GROUP_DOWNLOADS)
+
+        async def _fetch(fid: str) -> bytearray:
+            async with download_sem:
+                f = await bot.get_file(fid)
+                return await f.download_as_bytearray()
+
+        images: list[bytes | bytearray] = list(
+            await asyncio.gather(*(_fetch(fid) for fid in file_ids))
+        )
 
-        existing = list(user_data.get("pending_images", []))
+        existing = list(_get_pending(user_id))
         if model == "gpt-5.2":
             images = images[:1]  # Текстовый режим: только 1 фото
         else:
@@ -531,17 +755,12 @@ def run_telegram_bot():
             images = images[-10:]
             await first_update.message.reply_text("Максимум 10 изображений. Использую последние 10.")
 
-        class Ctx:
-            pass
-        ctx = Ctx()
-        ctx.bot = bot
-        ctx.application = application
-        ctx.user_data = application.user_data[user_id]
+        ctx = SimpleNamespace(bot=bot, application=application, user_data=user_data)
         if caption:
-            user_data["pending_images"] = []
+            _set_pending(user_id, [])
             await process_and_reply(first_update, ctx, images, caption)
         else:
-            user_data["pending_images"] = images
+            _set_pending(user_id, images)
             model_label = MODEL_LABELS.get(model, model)
             await first_update.message.reply_text(
                 f"Получено {len(images)} изображений. Модель: {model_label}\n"
@@ -552,19 +771,20 @@ def run_telegram_bot():
         message = update.message
         user = update.effective_user
         caption = (message.caption or "").strip()
+        model = get_model(context)
 
         # Режим RAG: только текстовые вопросы
-        if get_model(context) == "rag_text":
+        if model == "rag_text":
             await message.reply_text("В режиме RAG отправляйте только текстовые вопросы.")
             return
 
         # Режимы create/dalle_create: только текст. Одиночное фото — обрабатываем caption
-        if get_model(context) in ("create", "dalle_create") and not message.media_group_id:
+        if model in ("create", "dalle_create") and not message.media_group_id:
             if caption:
-                context.user_data["pending_images"] = []
+                _set_pending(user.id, [])
                 await process_and_reply(update, context, [], caption)
             else:
-                mode_name = "DALL-E Gen" if get_model(context) == "dalle_create" else "Create"
+                mode_name = "DALL-E Gen" if model == "dalle_create" else "Create"
                 await message.reply_text(
                     f"В режиме {mode_name} отправьте только текстовое описание изображения "
                     "(без фото)."
@@ -575,7 +795,8 @@ def run_telegram_bot():
         if message.media_group_id:
             file_id = None
             if message.photo:
-                file_id = max(message.photo, key=lambda p: p.file_size).file_id
+                # PhotoSize упорядочены по возрастанию размера — последний самый большой
+                file_id = message.photo[-1].file_id
             elif message.document and (message.document.mime_type or "").startswith("image/"):
                 file_id = message.document.file_id
 
@@ -585,6 +806,7 @@ def run_telegram_bot():
                 return
 
             group_id = str(message.media_group_id)
+            media_groups = context.application.bot_data.setdefault("media_groups", {})
             if group_id in media_groups:
                 media_groups[group_id]["file_ids"].append(file_id)
                 logger.debug(
@@ -599,31 +821,34 @@ def run_telegram_bot():
                     "user_id": user.id,
                     "first_update": update,
                 }
-                asyncio.create_task(
-                    process_media_group_after_delay(
-                        group_id, context.bot, context.application
-                    )
+                asyncio.get_running_loop().call_later(
+                    MEDIA_GROUP_DELAY,
+                    _flush_media_group,
+                    group_id,
+                    context.bot,
+                    context.application,
                 )
                 logger.info("Начат сбор альбома %s от user_id=%s", group_id, user.id)
             return
 
         # Одиночное фото или документ
-        images: list[bytes] = list(context.user_data.get("pending_images", []))
-        if get_model(context) == "gpt-5.2":
+        images: list[bytes | bytearray] = list(_get_pending(user.id))
+        if model == "gpt-5.2":
             images = []  # Текстовый режим: только 1 новое фото
 
-        logger.info(
-            "Получены изображения от user_id=%s: photo=%s, document=%s, caption=%r",
-            user.id,
-            bool(message.photo),
-            bool(message.document),
-            caption or None,
-        )
+        if logger.isEnabledFor(logging.INFO):
+            logger.info(
+                "Получены изображения от user_id=%s: photo=%s, document=%s, caption=%r",
+                user.id,
+                bool(message.photo),
+                bool(message.document),
+                caption or None,
+            )
 
         if message.photo:
-            largest = max(message.photo, key=lambda p: p.file_size)
+            largest = message.photo[-1]  # размеры отсортированы по возрастанию
             file = await context.bot.get_file(largest.file_id)
-            images.append(bytes(await file.download_as_bytearray()))
+            images.append(await file.download_as_bytearray())
         elif message.document:
             doc = message.document
             mime = doc.mime_type or ""
@@ -633,7 +858,7 @@ def run_telegram_bot():
                 await message.reply_text("Поддерживаются только изображения (PNG, JPEG).")
                 return
             file = await context.bot.get_file(doc.file_id)
-            images.append(bytes(await file.download_as_bytearray()))
+            images.append(await file.download_as_bytearray())
 
         if len(images) > 10:
             logger.info("Обрезка до 10 изображений (получено %d)", len(images))
@@ -647,12 +872,11 @@ def run_telegram_bot():
                 len(images),
                 caption,
             )
-            context.user_data["pending_images"] = []
+            _set_pending(user.id, [])
             await process_and_reply(update, context, images, caption)
         else:
-            context.user_data["pending_images"] = images
+            _set_pending(user.id, images)
             logger.debug("Сохранено %d изображений в pending для user_id=%s", len(images), user.id)
-            model = get_model(context)
             model_label = MODEL_LABELS.get(model, model)
             await message.reply_text(
                 f"Получено {len(images)} изображений. Модель: {model_label}\n"
@@ -663,17 +887,19 @@ def run_telegram_bot():
         message = update.message
         user = update.effective_user
         text = (message.text or "").strip()
-        images = context.user_data.get("pending_images", [])
+        model = get_model(context)
+        images = _get_pending(user.id)
 
-        logger.info(
-            "Текстовое сообщение от user_id=%s: %r, pending_images=%d",
-            user.id,
-            text[:100],
-            len(images),
-        )
+        if logger.isEnabledFor(logging.INFO):
+            logger.info(
+                "Текстовое сообщение от user_id=%s: %r, pending_images=%d",
+                user.id,
+                text[:100],
+                len(images),
+            )
 
         # Режим RAG: текст как вопрос по документам
-        if get_model(context) == "rag_text":
+        if model == "rag_text":
             if not text:
                 await message.reply_text("Введите вопрос для поиска в RAG.")
                 return
@@ -683,38 +909,38 @@ def run_telegram_bot():
             return
 
         # Режим create: только текст, без изображений
-        if get_model(context) == "create":
+        if model == "create":
             if not text:
                 await message.reply_text("Введите текстовое описание изображения.")
                 return
             if len(text) > 4000:
                 text = text[:4000] + "\n\n[... обрезано]"
                 await message.reply_text("Описание обрезано до 4000 символов.")
-            context.user_data["pending_images"] = []
+            _set_pending(user.id, [])
             await process_and_reply(update, context, [], text)
             return
 
         # Режим dalle_create: только текст (DALL-E 2, лимит 1000 символов)
-        if get_model(context) == "dalle_create":
+        if model == "dalle_create":
             if not text:
                 await message.reply_text("Введите текстовое описание изображения.")
                 return
             if len(text) > 1000:
                 text = text[:1000] + "\n\n[... обрезано]"
                 await message.reply_text("DALL-E 2: описание обрезано до 1000 символов.")
-            context.user_data["pending_images"] = []
+            _set_pending(user.id, [])
             await process_and_reply(update, context, [], text)
             return
 
         # Режим text (gpt-5.2): можно только текст ИЛИ текст + 1 фото
-        if get_model(context) == "gpt-5.2":
+        if model == "gpt-5.2":
             if not text:
                 await message.reply_text("Введите сообщение или отправьте фото с подписью.")
                 return
             if len(text) > 4000:
                 text = text[:4000] + "\n\n[... обрезано]"
                 await message.reply_text("Промпт обрезан до 4000 символов.")
-            context.user_data["pending_images"] = []
+            _set_pending(user.id, [])
             await process_and_reply(update, context, images, text)
             return
 
@@ -730,24 +956,86 @@ def run_telegram_bot():
             text = text[:4000] + "\n\n[... обрезано]"
             await message.reply_text("Промпт обрезан до 4000 символов.")
 
-        context.user_data["pending_images"] = []
+        _set_pending(user.id, [])
         await process_and_reply(update, context, images, text)
 
     def chunk_text(text: str, max_len: int = TELEGRAM_MAX_MESSAGE) -> list[str]:
         """Разбивает текст на части не более max_len символов."""
-        if len(text) <= max_len:
+        n = len(text)
+        # Быстрый путь: большинство ответов помещается в одно сообщение
+        if n <= max_len:
             return [text] if text else []
         chunks = []
-        while text:
-            chunk = text[:max_len]
+        i = 0  # курсор по исходной строке — без копирования остатка на каждой итерации
+        while i < n:
+            end = min(i + max_len, n)
             # Пытаемся разбить по переносу строки
-            last_nl = chunk.rfind("\n")
-            if last_nl > max_len // 2:
-                chunk = text[: last_nl + 1]
-            chunks.append(chunk)
-            text = text[len(chunk) :]
+            last_nl = text.rfind("\n", i + max_len // 2 + 1, end)
+            if last_nl != -1:
+                end = last_nl + 1
+            chunks.append(text[i:end])
+            i = end
         return chunks
 
+    async def _run_generation(
+        update: Update,
+        status_text: str,
+        model_label: str,
+        log_tag: str,
+        func,
+        model: str,
+        prompt: str,
+        images: list | None = None,
+    ) -> None:
+        """
+        Общий путь генерации изображения: статус → вызов OpenAI → фото с подписью.
+        func — processor.process (с images) или processor.process_create (images=None);
+        из тех же аргументов строится и вызов, и ключ кэша.
+        """
+        user = update.effective_user
+        message = await update.message.reply_text(status_text)
+        args = (prompt,) if images is None else (images, prompt)
+        call = functools.partial(func, *args, model=model)
+        try:
+            result_bytes, usage_str = await _run_in_image_executor(
+                _cached_image_call, call, model, prompt, images or ()
+            )
+        except ValueError as e:
+            logger.warning("Ошибка валидации %s для user_id=%s: %s", log_tag, user.id, e)
+            await message.edit_text(str(e))
+            return
+        except Exception as e:
+            code = _image_error_code(e)
+            err_msg = _format_image_error(e, code)
+            if code == "moderation_blocked":
+                logger.info("%s: moderation blocked для user_id=%s", log_tag, user.id)
+            else:
+                logger.exception(
+                    "Ошибка %s для user_id=%s: %s",
+                    log_tag,
+                    user.id,
+                    e,
+                )
+            await message.edit_text(err_msg)
+            return
+
+        logger.info(
+            "Успешная обработка %s для user_id=%s: результат %d байт",
+            log_tag,
+            user.id,
+            len(result_bytes),
+        )
+
+        # Отправляем из памяти: без временного файла и гонок между пользователями
+        photo = io.BytesIO(result_bytes)
+        photo.name = "output.png"
+        caption = f"Модель: {model_label}"
+        if usage_str:
+            caption += f"\n{usage_str}"
+        await update.message.reply_photo(photo=photo, caption=caption)
+        logger.debug("Фото отправлено user_id=%s", user.id)
+        await message.delete()
+
     async def process_and_reply(
         update: Update,
         context: ContextTypes.DEFAULT_TYPE,
@@ -764,88 +1052,19 @@ def run_telegram_bot():
             prompt,
         )
 
-        # Режим create: только текст → изображение (images.generate, gpt-image-1.5)
-        if model == "create":
+        # Режимы create/dalle_create: только текст → изображение (images.generate)
+        if model in CREATE_MODELS:
+            api_model = CREATE_MODELS[model]
             model_label = MODEL_LABELS.get(model, model)
-            message = await update.message.reply_text(
-                f"Генерирую изображение ({model_label})…"
+            await _run_generation(
+                update,
+                f"Генерирую изображение ({model_label})…",
+                model_label,
+                model,
+                processor.process_create,
+                api_model,
+                prompt,
             )
-            try:
-                result_bytes, usage_str = await asyncio.to_thread(
-                    processor.process_create,
-                    prompt,
-                    model="gpt-image-1.5",
-                )
-            except ValueError as e:
-                await message.edit_text(str(e))
-                return
-            except Exception as e:
-                err_msg = _format_image_error(e)
-                if "moderation_blocked" in str(e):
-                    logger.info("Create: moderation blocked для user_id=%s", user.id)
-                else:
-                    logger.exception(
-                        "Ошибка create для user_id=%s: %s",
-                        user.id,
-                        e,
-                    )
-                await message.edit_text(err_msg)
-                return
-            output = Path("temp_output.png")
-            output.write_bytes(result_bytes)
-            caption = f"Модель: {model_label}"
-            if usage_str:
-                caption += f"\n{usage_str}"
-            try:
-                await update.message.reply_photo(
-                    photo=output.open("rb"),
-                    caption=caption,
-                )
-            finally:
-                output.unlink(missing_ok=True)
-            await message.delete()
-            return
-
-        # Режим dalle_create: только текст → изображение (images.generate, DALL-E 2)
-        if model == "dalle_create":
-            model_label = MODEL_LABELS.get(model, model)
-            message = await update.message.reply_text(
-                f"Генерирую изображение ({model_label})…"
-            )
-            try:
-                result_bytes, usage_str = await asyncio.to_thread(
-                    processor.process_create,
-                    prompt,
-                    model="dall-e-2",
-                )
-            except ValueError as e:
-                await message.edit_text(str(e))
-                return
-            except Exception as e:
-                err_msg = _format_image_error(e)
-                if "moderation_blocked" in str(e):
-                    logger.info("DALL-E create: moderation blocked для user_id=%s", user.id)
-                else:
-                    logger.exception(
-                        "Ошибка dalle_create для user_id=%s: %s",
-                        user.id,
-                        e,
-                    )
-                await message.edit_text(err_msg)
-                return
-            output = Path("temp_output.png")
-            output.write_bytes(result_bytes)
-            caption = f"Модель: {model_label}"
-            if usage_str:
-                caption += f"\n{usage_str}"
-            try:
-                await update.message.reply_photo(
-                    photo=output.open("rb"),
-                    caption=caption,
-                )
-            finally:
-                output.unlink(missing_ok=True)
-            await message.delete()
             return
 
         # Текстовый режим (gpt-5.2): только текст ИЛИ 1 изображение + текст ИЛИ текст с контекстом документа
@@ -903,58 +1122,30 @@ def run_telegram_bot():
 
         # Режим генерации изображений
         model_label = MODEL_LABELS.get(model, model)
-        message = await update.message.reply_text(
-            f"Обрабатываю изображения ({model_label})…"
-        )
-        try:
-            result_bytes, usage_str = await asyncio.to_thread(
-                processor.process,
-                images,
-                prompt,
-                model=model,
-            )
-        except ValueError as e:
-            logger.warning("Ошибка валидации для user_id=%s: %s", user.id, e)
-            await message.edit_text(str(e))
-            return
-        except Exception as e:
-            err_msg = _format_image_error(e)
-            if "moderation_blocked" in str(e):
-                logger.info("Обработка: moderation blocked для user_id=%s", user.id)
-            else:
-                logger.exception(
-                    "Ошибка при обработке для user_id=%s: %s",
-                    user.id,
-                    e,
-                )
-            await message.edit_text(err_msg)
-            return
-
-        logger.info(
-            "Успешная обработка для user_id=%s: результат %d байт",
-            user.id,
-            len(result_bytes),
+        await _run_generation(
+            update,
+            f"Обрабатываю изображения ({model_label})…",
+            model_label,
+            model,
+            processor.process,
+            model,
+            prompt,
+            images,
         )
 
-        output = Path("temp_output.png")
-        output.write_bytes(result_bytes)
-        caption = f"Модель: {model_label}"
-        if usage_str:
-            caption += f"\n{usage_str}"
-        try:
-            await update.message.reply_photo(
-                photo=output.open("rb"),
-                caption=caption,
-            )
-            logger.debug("Фото отправлено user_id=%s", user.id)
-        finally:
-            output.unlink(missing_ok=True)
-        await message.delete()
-
     def main():
         persistence_path = os.environ.get("BOT_DATA_PATH", "bot_data.pickle")
-        persistence = PicklePersistence(persistence_path)
-        app = Application.builder().token(token).persistence(persistence).build()
+        # bot_data содержит только временное состояние (альбомы в сборке) — не сохраняем
+        persistence = SlimPicklePersistence(
+            persistence_path, store_data=PersistenceInput(bot_data=False)
+        )
+        app = (
+            Application.builder()
+            .token(token)
+            .persistence(persistence)
+            .rate_limiter(SemaphoreRateLimiter())
+            .build()
+        )
         app.add_handler(CommandHandler("start", start))
         app.add_handler(CommandHandler("text", cmd_text))
         app.add_handler(CommandHandler("image1", cmd_image1))
@@ -3,17 +3,30 @@
 Принимает 1-10 изображений и текстовую команду, возвращает изображение в высоком качестве.
 """
 
-import base64
 import io
 import logging
 import time
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from typing import BinaryIO
 
+import httpx
 from openai import OpenAI
 
+# pybase64 — SIMD-реализация base64 (в разы быстрее на изображениях в несколько МБ)
+try:
+    from pybase64 import b64decode, b64encode_as_string
+except ImportError:
+    from base64 import b64decode, b64encode
+
+    def b64encode_as_string(data: bytes) -> str:
+        return b64encode(data).decode("ascii")
+
 logger = logging.getLogger(__name__)
 
+# Общий HTTP-клиент для скачивания результатов по URL (переиспользует соединения)
+_HTTP_CLIENT = httpx.Client(timeout=120.0, follow_redirects=True)
+
 
 def _format_usage(usage) -> str | None:
     """Форматирует usage из ответа API в строку для отображения."""
@@ -29,6 +42,53 @@ def _format_usage(usage) -> str | None:
     return f"Токены: {total}"
 
 
+def _image_result_bytes(item) -> bytes:
+    """
+    Байты изображения из элемента result.data: скачивает по url
+    (без base64 в ответе) или декодирует b64_json.
+    """
+    if getattr(item, "url", None):
+        buf = bytearray()
+        with _HTTP_CLIENT.stream("GET", item.url) as resp:
+            resp.raise_for_status()
+            for chunk in resp.iter_bytes(65536):
+                buf.extend(chunk)
+        return bytes(buf)
+    return b64decode(item.b64_json)
+
+
+# Сигнатуры форматов: (префикс, mimetype, расширение). WEBP проверяется отдельно (RIFF....WEBP)
+_MAGICS = (
+    (b"\xff\xd8\xff", "image/jpeg", "jpg"),
+    (b"\x89PNG\r\n\x1a\n", "image/png", "png"),
+)
+
+
+def _sniff_mime(data: bytes) -> tuple[str, str] | None:
+    """Определяет формат по magic bytes. Возвращает (mimetype, расширение) или None."""
+    for sig, mime, ext in _MAGICS:
+        if data.startswith(sig):
+            return mime, ext
+    if data.startswith(b"RIFF") and data.startswith(b"WEBP", 8):
+        return "image/webp", "webp"
+    return None
+
+
+def _image_result(result, start_time: float, action: str) -> tuple[bytes, str | None]:
+    """Разбирает ответ images.edit/generate: (байты изображения, usage)."""
+    elapsed = time.perf_counter() - start_time
+    logger.info("%s: ответ OpenAI получен за %.2f сек", action, elapsed)
+
+    item = result.data[0] if result.data else None
+    if item is None or not (item.b64_json or getattr(item, "url", None)):
+        logger.error("OpenAI вернул пустой ответ: data=%r", result.data)
+        raise RuntimeError("OpenAI не вернул изображение")
+
+    decoded = _image_result_bytes(item)
+    logger.info("%s завершена: результат %.1f КБ", action, len(decoded) / 1024)
+    return decoded, _format_usage(result.usage)
+
+
 class ImageProcessor:
     """Обработчик изображений через OpenAI gpt-image-1.5."""
 
@@ -60,7 +120,7 @@ class ImageProcessor:
         Обрабатывает изображения по текстовой команде.
 
         Args:
-            images: Список из 1-10 изображений (путь к файлу, файловый объект или bytes).
+            images: Список из 1-10 изображений (путь к файлу, файловый объект, bytes или bytearray).
             prompt: Текстовая команда для обработки.
             quality: Качество выходного изображения (low, medium, high, auto).
             size: Размер (1024x1024, 1536x1024, 1024x1536, auto).
@@ -69,14 +129,29 @@ class ImageProcessor:
     Returns:
         Кортеж (байты изображения, строка с использованием токенов или None).
         """
+        edit_kwargs = self._prepare_edit(
+            images, prompt, model or self.MODEL, quality, size, output_format
+        )
+        start_time = time.perf_counter()
+        result = self.client.images.edit(**edit_kwargs)
+        return _image_result(result, start_time, "Обработка")
+
+    def _prepare_edit(
+        self,
+        images: list[Path | BinaryIO | bytes],
+        prompt: str,
+        model: str,
+        quality: str,
+        size: str,
+        output_format: str,
+    ) -> dict:
+        """Проверяет входные данные и собирает параметры images.edit."""
         logger.info(
             "Начало обработки: %d изображений, prompt=%r",
             len(images),
             prompt,
         )
 
-        model = model or self.MODEL
-
         if not 1 <= len(images) <= 10:
             logger.warning("Недопустимое количество изображений: %d", len(images))
             raise ValueError("Количество изображений должно быть от 1 до 10")
@@ -100,25 +175,20 @@ class ImageProcessor:
         image_files = self._prepare_images(images)
         logger.debug("Подготовлено %d файлов для отправки", len(image_files))
 
-        start_time = time.perf_counter()
         try:
             # OpenAI SDK требует (filename, fileobj, mimetype) для bytes/Stream,
             # иначе ставит application/octet-stream
-            api_images = [
-                self._to_api_format(item, i, []) for i, item in enumerate(image_files)
-            ]
-
-            full_prompt = self.SYSTEM_PROMPT + prompt.strip()
-            edit_kwargs = dict(
-                model=model,
-                image=api_images,
-                prompt=full_prompt,
-                quality=quality,
-                size=size,
-                output_format=output_format,
-            )
-            result = self.client.images.edit(**edit_kwargs)
+            datas = [self._read_image_data(f) for f in image_files]
+            # PNG/JPEG/WEBP уходят как есть; пул нужен, только если перекодировать
+            # через Pillow (отпускает GIL) придётся несколько файлов
+            to_convert = sum(1 for d in datas if _sniff_mime(d) is None)
+            if to_convert > 1:
+                with ThreadPoolExecutor(max_workers=to_convert) as ex:
+                    api_images = list(ex.map(self._to_api_format, datas, range(len(datas))))
+            else:
+                api_images = [self._to_api_format(d, i) for i, d in enumerate(datas)]
         finally:
+            # Данные уже скопированы в api_images, исходные файлы больше не нужны
             for f in image_files:
                 if hasattr(f, "close"):
                     try:
@@ -126,66 +196,78 @@ class ImageProcessor:
                     except Exception:
                         pass
 
-        elapsed = time.perf_counter() - start_time
-        logger.info("OpenAI ответ получен за %.2f сек", elapsed)
+        full_prompt = "".join((self.SYSTEM_PROMPT, prompt.strip()))
+        return self._build_edit_kwargs(model, api_images, full_prompt, quality, size, output_format)
 
-        if not result.data or not result.data[0].b64_json:
-            logger.error("OpenAI вернул пустой ответ: data=%r", result.data)
-            raise RuntimeError("OpenAI не вернул изображение")
+    @staticmethod
+    def _build_edit_kwargs(
+        model: str, images: list, full_prompt: str, quality: str, size: str, output_format: str
+    ) -> dict:
+        """Собирает параметры images.edit."""
+        kwargs = dict(
+            model=model,
+            image=images,
+            prompt=full_prompt,
+            quality=quality,
+            size=size,
+            output_format=output_format,
+        )
+        if model.startswith("dall-e"):
+            # DALL-E отдаёт ссылку на PNG — скачиваем напрямую, без base64
+            kwargs["response_format"] = "url"
+        return kwargs
 
-        decoded = base64.b64decode(result.data[0].b64_json)
-        logger.info("Обработка завершена: результат %.1f КБ", len(decoded) / 1024)
-        usage_str = _format_usage(result.usage)
-        return decoded, usage_str
+    @staticmethod
+    def _read_image_data(fileobj) -> bytes | bytearray:
+        """Содержимое файла изображения (bytes/bytearray возвращаются как есть)."""
+        if hasattr(fileobj, "seek"):
+            fileobj.seek(0)
+        return fileobj.read() if hasattr(fileobj, "read") else fileobj
 
     def _to_api_format(self, fileobj, index: int, _temp_files: list = None):
         """
         Преобразует файл в формат (filename, fileobj, mimetype) для OpenAI API.
         bytes и BytesIO без расширения приводят к application/octet-stream,
-        поэтому нормализуем через Pillow в PNG/JPEG с явным mimetype.
+        поэтому задаём mimetype явно. PNG/JPEG/WEBP определяются по magic bytes
+        и отправляются как есть, остальное перекодируется через Pillow в PNG.
         """
         from PIL import Image
 
-        if hasattr(fileobj, "seek"):
-            fileobj.seek(0)
-        data = fileobj.read() if hasattr(fileobj, "read") else fileobj
+        data = self._read_image_data(fileobj)
+
+        sniffed = _sniff_mime(data)
+        if sniffed:
+            mime, ext = sniffed
+            filename = f"image_{index}.{ext}"
+            logger.debug("Изображение %d: %s, mimetype=%s (без перекодирования)", index + 1, filename, mime)
+            return (filename, io.BytesIO(data), mime)
 
         try:
             with Image.open(io.BytesIO(data)) as im:
-                fmt = (im.format or "").upper()
-                # OpenAI поддерживает: image/png, image/jpeg, image/webp
-                if fmt == "PNG":
-                    ext, save_fmt, mime = "png", "PNG", "image/png"
-                elif fmt in ("JPEG", "JPG"):
-                    ext, save_fmt, mime = "jpg", "JPEG", "image/jpeg"
-                elif fmt == "WEBP":
-                    ext, save_fmt, mime = "webp", "WEBP", "image/webp"
-                else:
-                    ext, save_fmt, mime = "png", "PNG", "image/png"
-
+                # OpenAI поддерживает: image/png, image/jpeg, image/webp;
+                # прочие форматы (GIF, BMP, TIFF…) отправляем как PNG
                 if im.mode not in ("RGB", "RGBA", "L"):
                     im = im.convert("RGB")
 
                 buf = io.BytesIO()
-                if save_fmt == "JPEG":
-                    if im.mode in ("RGBA", "LA", "P"):
-                        im = im.convert("RGB")
-                    im.save(buf, format="JPEG", quality=95)
-                else:
-                    im.save(buf, format=save_fmt)
+                im.save(buf, format="PNG")
                 buf.seek(0)
 
-                filename = f"image_{index}.{ext}"
-                logger.debug("Изображение %d: %s, mimetype=%s", index + 1, filename, mime)
-                return (filename, buf, mime)
+                filename = f"image_{index}.png"
+                logger.debug("Изображение %d: %s, mimetype=image/png", index + 1, filename)
+                return (filename, buf, "image/png")
         except Exception as e:
             logger.exception("Не удалось обработать изображение %d: %s", index + 1, e)
             raise ValueError(f"Неподдерживаемый или повреждённый файл изображения: {e}") from e
 
     def _prepare_images(
         self, images: list[Path | BinaryIO | bytes]
-    ) -> list[BinaryIO | tuple]:
-        """Подготавливает изображения для отправки в API."""
+    ) -> list[BinaryIO | bytes | bytearray]:
+        """
+        Подготавливает изображения для отправки в API.
+        Байты передаются как есть, без обёртки в BytesIO: _to_api_format
+        принимает их напрямую, так обходимся без лишней копии.
+        """
         prepared = []
         for i, img in enumerate(images):
             if isinstance(img, Path):
@@ -194,14 +276,11 @@ class ImageProcessor:
                     prepared.append(open(img, "rb"))
                     logger.debug("Изображение %d: Path %s", i + 1, img)
                 else:
-                    # Расширение не из белого списка — нормализуем через Pillow
-                    with open(img, "rb") as f:
-                        data = f.read()
-                    buf = io.BytesIO(data)
-                    prepared.append(buf)
+                    # Расширение не из белого списка — формат определит _to_api_format
+                    prepared.append(img.read_bytes())
                     logger.debug("Изображение %d: Path %s (нормализация)", i + 1, img)
-            elif isinstance(img, bytes):
-                prepared.append(io.BytesIO(img))
+            elif isinstance(img, (bytes, bytearray)):
+                prepared.append(img)
                 logger.debug("Изображение %d: bytes, размер %d", i + 1, len(img))
             elif hasattr(img, "read"):
                 if hasattr(img, "seek"):
@@ -237,14 +316,9 @@ class ImageProcessor:
         else:
             data = image
 
-        b64 = base64.b64encode(data).decode("utf-8")
-        mime = "image/png"  # или определить по magic bytes
-        if data[:3] == b"\xff\xd8\xff":
-            mime = "image/jpeg"
-        elif data[:8] == b"\x89PNG\r\n\x1a\n":
-            mime = "image/png"
-        elif data[:4] == b"RIFF" and data[8:12] == b"WEBP":
-            mime = "image/webp"
+        b64 = b64encode_as_string(data)
+        sniffed = _sniff_mime(data)
+        mime = sniffed[0] if sniffed else "image/png"
 
         content = [
             {"type": "text", "text": prompt.strip()},
@@ -347,8 +421,15 @@ class ImageProcessor:
         Returns:
             Кортеж (байты изображения, строка с использованием токенов или None).
         """
-        model = model or self.MODEL
+        kwargs = self._create_kwargs(prompt, model or self.MODEL, quality, size, output_format)
+        start_time = time.perf_counter()
+        result = self.client.images.generate(**kwargs)
+        return _image_result(result, start_time, "Генерация")
 
+    def _create_kwargs(
+        self, prompt: str, model: str, quality: str, size: str, output_format: str
+    ) -> dict:
+        """Проверяет описание и собирает параметры images.generate."""
         if not prompt or not prompt.strip():
             raise ValueError("Текстовое описание не может быть пустым")
 
@@ -359,37 +440,22 @@ class ImageProcessor:
 
         logger.info("Генерация изображения по тексту: model=%s, prompt=%r", model, prompt[:100])
 
-        start_time = time.perf_counter()
         if model.startswith("dall-e"):
-            kwargs = dict(
-                prompt=prompt.strip(),
-                model=model,
-                size=size,
-                n=1,
-                response_format="b64_json",
-            )
-        else:
-            kwargs = dict(
+            return dict(
                 prompt=prompt.strip(),
                 model=model,
-                quality=quality,
                 size=size,
-                output_format=output_format,
                 n=1,
+                response_format="url",
             )
-
-        result = self.client.images.generate(**kwargs)
-        elapsed = time.perf_counter() - start_time
-        logger.info("OpenAI generate ответ за %.2f сек", elapsed)
-
-        if not result.data or not result.data[0].b64_json:
-            logger.error("OpenAI вернул пустой ответ: data=%r", result.data)
-            raise RuntimeError("OpenAI не вернул изображение")
-
-        decoded = base64.b64decode(result.data[0].b64_json)
-        logger.info("Генерация завершена: результат %.1f КБ", len(decoded) / 1024)
-        usage_str = _format_usage(result.usage)
-        return decoded, usage_str
+        return dict(
+            prompt=prompt.strip(),
+            model=model,
+            quality=quality,
+            size=size,
+            output_format=output_format,
+            n=1,
+        )
 
 
 def process_images(
@@ -5,11 +5,28 @@ RAG-хранилище на ChromaDB.
 
 import hashlib
 import logging
+import os
 import re
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 from pathlib import Path
 from typing import Iterator
 
-from openai import OpenAI
+from openai import OpenAI, RateLimitError
+
+# orjson — быстрый JSON на Rust (манифест на тысячи источников читается при каждом старте)
+try:
+    from orjson import dumps as _json_dumps, loads as _json_loads
+except ImportError:
+    import json
+
+    def _json_dumps(obj) -> bytes:
+        return json.dumps(obj, ensure_ascii=False).encode("utf-8")
+
+    _json_loads = json.loads
 
 logger = logging.getLogger(__name__)
 
@@ -17,6 +34,14 @@ DATA_DIR = Path("data")
 CHUNK_SIZE = 500
 CHUNK_OVERLAP = 50
 EMBEDDING_MODEL = "text-embedding-3-small"
+# Лимиты одного запроса embeddings: до 2048 входов и 300k токенов суммарно.
+# Батч меньше лимита: WORKERS * MAX_TOKENS (200k) в полёте укладываются в TPM младших тарифов
+EMBEDDING_BATCH_MAX_ITEMS = 2048
+EMBEDDING_BATCH_MAX_TOKENS = 50_000
+EMBEDDING_WORKERS = 4  # параллельных запросов при индексации
+EMBEDDING_RATE_LIMIT_RETRIES = 5  # повторов батча на 429 сверх повторов SDK
+MANIFEST_FILE = "manifest.json"  # в persist_directory: что и когда проиндексировано
+QUERY_EMBEDDING_CACHE_SIZE = 1024  # эмбеддингов повторяющихся запросов в памяти
 
 
 def _chunk_text(text: str, chunk_size: int = CHUNK_SIZE, overlap: int = CHUNK_OVERLAP) -> list[str]:
@@ -24,20 +49,23 @@ def _chunk_text(text: str, chunk_size: int = CHUNK_SIZE, overlap: int = CHUNK_OV
     if not text or not text.strip():
         return []
     text = text.strip()
-    chunks = []
+    n = len(text)
+    # Сначала только границы чанков (без промежуточных подстрок), затем сами чанки
+    bounds: list[tuple[int, int]] = []
     start = 0
-    while start < len(text):
+    while start < n:
         end = start + chunk_size
-        chunk = text[start:end]
-        if end < len(text):
-            last_space = chunk.rfind(" ")
-            if last_space > chunk_size // 2:
-                chunk = chunk[: last_space + 1]
-                end = start + last_space + 1
-        chunk = chunk.strip()
+        if end < n:
+            last_space = text.rfind(" ", start + chunk_size // 2 + 1, end)
+            if last_space != -1:
+                end = last_space + 1
+        bounds.append((start, end))
+        start = end - overlap if end < n else n
+    chunks = []
+    for s, e in bounds:
+        chunk = text[s:e].strip()
         if chunk:
             chunks.append(chunk)
-        start = end - overlap if end < len(text) else len(text)
     return chunks
 
 
@@ -47,7 +75,15 @@ def _load_txt(path: Path) -> str:
 
 
 def _load_pdf(path: Path) -> str:
-    """Загружает PDF и извлекает текст."""
+    """Загружает PDF и извлекает текст (PyMuPDF, если установлен, иначе pypdf)."""
+    try:
+        import fitz  # PyMuPDF: извлечение текста на C, в разы быстрее pypdf
+    except ImportError:
+        pass
+    else:
+        with fitz.open(path) as doc:
+            return "\n\n".join(page.get_text("text") for page in doc)
+
     from pypdf import PdfReader
     reader = PdfReader(path)
     parts = []
@@ -56,17 +92,47 @@ def _load_pdf(path: Path) -> str:
     return "\n\n".join(parts)
 
 
+def _cell_text(c) -> str:
+    """Текст ячейки; целые числа без ".0" (calamine отдаёт все числа как float)."""
+    if c is None:
+        return ""
+    if isinstance(c, float) and c.is_integer():
+        return str(int(c))
+    return str(c)
+
+
+def _iter_row_texts(rows) -> Iterator[str]:
+    """Строки таблицы в виде "a | b | c", пустые пропускаются."""
+    for row in rows:
+        row_text = " | ".join(_cell_text(c) for c in row)
+        if row_text.strip():
+            yield row_text
+
+
 def _load_xlsx(path: Path) -> str:
-    """Загружает XLSX и извлекает текст из ячеек."""
+    """Загружает XLSX и извлекает текст из ячеек (python-calamine, иначе openpyxl)."""
+    try:
+        from python_calamine import CalamineWorkbook  # Rust calamine: в разы быстрее openpyxl
+    except ImportError:
+        pass
+    else:
+        wb = CalamineWorkbook.from_path(str(path))
+        return "\n".join(
+            row_text
+            for name in wb.sheet_names
+            for row_text in _iter_row_texts(wb.get_sheet_by_name(name).to_python())
+        )
+
     from openpyxl import load_workbook
     wb = load_workbook(path, read_only=True, data_only=True)
-    parts = []
-    for sheet in wb.worksheets:
-        for row in sheet.iter_rows(values_only=True):
-            row_text = " | ".join(str(c) if c is not None else "" for c in row)
-            if row_text.strip():
-                parts.append(row_text)
-    return "\n".join(parts)
+    try:
+        return "\n".join(
+            row_text
+            for sheet in wb.worksheets
+            for row_text in _iter_row_texts(sheet.iter_rows(values_only=True))
+        )
+    finally:
+        wb.close()
 
 
 def _load_docx(path: Path) -> str:
@@ -100,6 +166,62 @@ def load_document(path: Path) -> str | None:
     return None
 
 
+def _count_tokens(texts: list[str]) -> list[int]:
+    """Число токенов каждого текста (tiktoken; без него — по числу символов, с запасом)."""
+    try:
+        import tiktoken
+
+        # Первый вызов скачивает словарь BPE — без сети считаем по символам
+        enc = tiktoken.encoding_for_model(EMBEDDING_MODEL)
+    except Exception as e:
+        if not isinstance(e, ImportError):
+            logger.warning("tiktoken недоступен (%s), токены оцениваются по символам", e)
+        return [len(t) for t in texts]
+    # encode_ordinary: "<|endoftext|>" в тексте документа — обычный текст, не ошибка
+    return [len(tokens) for tokens in enc.encode_ordinary_batch(texts)]
+
+
+def _pack_batches(token_counts: list[int]) -> list[tuple[int, int]]:
+    """Жадно упаковывает тексты в батчи [start, end) в пределах лимитов запроса."""
+    batches = []
+    start = 0
+    batch_tokens = 0
+    for i, n in enumerate(token_counts):
+        if i > start and (
+            batch_tokens + n > EMBEDDING_BATCH_MAX_TOKENS
+            or i - start >= EMBEDDING_BATCH_MAX_ITEMS
+        ):
+            batches.append((start, i))
+            start = i
+            batch_tokens = 0
+        batch_tokens += n
+    if start < len(token_counts):
+        batches.append((start, len(token_counts)))
+    return batches
+
+
+# Запись манифеста: один писатель за раз (RAGStore используется из нескольких потоков)
+_MANIFEST_LOCK = threading.Lock()
+
+_CHROMA_CLIENTS: dict[str, object] = {}
+_CHROMA_CLIENTS_LOCK = threading.Lock()
+
+
+def get_chroma_client(persist_dir: str | Path):
+    """Возвращает общий chromadb.PersistentClient для persist_dir (создаётся один раз)."""
+    key = str(Path(persist_dir).resolve())
+    with _CHROMA_CLIENTS_LOCK:
+        client = _CHROMA_CLIENTS.get(key)
+        if client is None:
+            import chromadb
+            from chromadb.config import Settings
+            client = chromadb.PersistentClient(
+                path=str(persist_dir), settings=Settings(anonymized_telemetry=False)
+            )
+            _CHROMA_CLIENTS[key] = client
+        return client
+
+
 def get_embedding(client: OpenAI, text: str) -> list[float]:
     """Получает эмбеддинг через OpenAI."""
     resp = client.embeddings.create(model=EMBEDDING_MODEL, input=text.strip())
@@ -114,11 +236,59 @@ class RAGStore:
         self.persist_dir.mkdir(parents=True, exist_ok=True)
         self.client = OpenAI(api_key=api_key)
         self._collection = None
+        self._manifest_path = self.persist_dir / MANIFEST_FILE
+        # Нет манифеста (индекс старой версии) или он не читается — источники берём
+        # из ChromaDB, пока полная индексация не запишет манифест заново
+        manifest = self._load_manifest()
+        self._has_manifest = manifest is not None
+        self._manifest = manifest or {}
+        # Кэш эмбеддингов запросов на экземпляр: повторный вопрос не идёт в API
+        self._query_embedding = lru_cache(maxsize=QUERY_EMBEDDING_CACHE_SIZE)(self._embed_query)
+
+    def _embed_query(self, normalized: str) -> tuple[float, ...]:
+        return tuple(get_embedding(self.client, normalized))
+
+    def _load_manifest(self) -> dict[str, list[int]] | None:
+        """Манифест индекса: {источник: [mtime_ns, size, количество чанков]} или None."""
+        try:
+            manifest = _json_loads(self._manifest_path.read_bytes())
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            logger.warning("Не удалось прочитать манифест %s: %s", self._manifest_path, e)
+            return None
+        if not isinstance(manifest, dict):
+            logger.warning("Некорректный манифест %s, источники берём из ChromaDB", self._manifest_path)
+            return None
+        return manifest
+
+    def _update_manifest(
+        self, changed: dict[str, list[int]] | None = None, removed: list[str] = ()
+    ) -> None:
+        """
+        Обновляет манифест и атомарно записывает его на диск.
+        Вызовы из разных потоков (/rag_index и /rag_delete) сериализуются,
+        у каждой записи свой временный файл.
+        """
+        with _MANIFEST_LOCK:
+            for src in removed:
+                self._manifest.pop(src, None)
+            if changed:
+                self._manifest.update(changed)
+            fd, tmp = tempfile.mkstemp(
+                dir=self.persist_dir, prefix=MANIFEST_FILE + ".", suffix=".tmp"
+            )
+            try:
+                with os.fdopen(fd, "wb") as f:
+                    f.write(_json_dumps(self._manifest))
+                os.replace(tmp, self._manifest_path)
+            except BaseException:
+                Path(tmp).unlink(missing_ok=True)
+                raise
+            self._has_manifest = True
 
     def _get_collection(self):
-        import chromadb
-        from chromadb.config import Settings
-        client = chromadb.PersistentClient(path=str(self.persist_dir), settings=Settings(anonymized_telemetry=False))
+        client = get_chroma_client(self.persist_dir)
         return client.get_or_create_collection(
             name="imagebot_rag",
             metadata={"description": "RAG collection for ImageBot"},
@@ -144,44 +314,90 @@ class RAGStore:
         exts = {".txt", ".text", ".md", ".pdf", ".xlsx", ".xls", ".docx"}
         files = [f for f in data_dir.rglob("*") if f.is_file() and f.suffix.lower() in exts]
 
+        # Источники, файлы которых удалены из data_dir, убираем из коллекции
+        present = {str(f.relative_to(data_dir)) for f in files}
+        known = set(self.list_sources())
+        vanished = [src for src in known if src not in present]
+        if vanished:
+            self.collection.delete(where={"source": {"$in": vanished}})
+            if self._has_manifest:
+                self._update_manifest(removed=vanished)
+            logger.info("Удалены из индекса отсутствующие файлы: %s", vanished)
+
         if not files:
             logger.info("Нет документов для индексации в %s", data_dir)
             return {}
 
-        # Собираем все чанки
+        # Собираем чанки изменившихся файлов; неизменённые (mtime, size) пропускаем
         all_ids: list[str] = []
         all_texts: list[str] = []
         all_metadatas: list[dict] = []
         source_counts: dict[str, int] = {}
+        changed: dict[str, list[int]] = {}
+        emptied: list[str] = []
 
         for path in sorted(files):
-            text = load_document(path)
-            if not text or not text.strip():
-                continue
             source = str(path.relative_to(data_dir))
-            chunks = _chunk_text(text)
+            stat = path.stat()
+            key = [stat.st_mtime_ns, stat.st_size]
+            entry = self._manifest.get(source)
+            if entry and entry[:2] == key:
+                source_counts[source] = entry[2]
+                continue
+            text = load_document(path)
+            chunks = _chunk_text(text) if text else []
             if not chunks:
+                # Файл стал пустым или перестал читаться — старые чанки больше не актуальны
+                if source in known:
+                    emptied.append(source)
                 continue
-            base_id = hashlib.md5(source.encode()).hexdigest()[:12]
+            base_id = hashlib.blake2b(source.encode(), digest_size=6).hexdigest()
             for i, chunk in enumerate(chunks):
                 doc_id = f"{base_id}_{i}"
                 all_ids.append(doc_id)
                 all_texts.append(chunk)
                 all_metadatas.append({"source": source})
             source_counts[source] = len(chunks)
+            changed[source] = key + [len(chunks)]
+
+        if emptied:
+            self.collection.delete(where={"source": {"$in": emptied}})
+            if self._has_manifest:
+                self._update_manifest(removed=emptied)
+            logger.info("Удалены из индекса пустые или нечитаемые файлы: %s", emptied)
 
         if not all_texts:
-            return {}
+            logger.info("Документы в %s не изменились, переиндексация не нужна", data_dir)
+            return source_counts
+
+        # Эмбеддинги батчами по числу токенов, запросы выполняются параллельно
+        batches = _pack_batches(_count_tokens(all_texts))
+
+        def embed_batch(bounds: tuple[int, int]) -> list[list[float]]:
+            start, end = bounds
+            for attempt in range(EMBEDDING_RATE_LIMIT_RETRIES + 1):
+                try:
+                    emb = self.client.embeddings.create(
+                        model=EMBEDDING_MODEL, input=all_texts[start:end]
+                    )
+                    break
+                except RateLimitError:
+                    if attempt >= EMBEDDING_RATE_LIMIT_RETRIES:
+                        raise
+                    delay = 2 ** attempt * 5
+                    logger.warning("Лимит OpenAI на эмбеддинги, повтор через %d сек", delay)
+                    time.sleep(delay)
+            return [e.embedding for e in emb.data]
 
-        # Эмбеддинги батчами (OpenAI лимит ~8000 токенов на запрос, ~3000 слов)
-        batch_size = 50
         all_embeddings: list[list[float]] = []
-
-        for i in range(0, len(all_texts), batch_size):
-            batch = all_texts[i : i + batch_size]
-            emb = self.client.embeddings.create(model=EMBEDDING_MODEL, input=batch)
-            all_embeddings.extend([e.embedding for e in emb.data])
-
+        with ThreadPoolExecutor(max_workers=min(EMBEDDING_WORKERS, len(batches))) as ex:
+            for embeddings in ex.map(embed_batch, batches):
+                all_embeddings.extend(embeddings)
+        logger.debug("Эмбеддинги: %d чанков в %d запросах", len(all_texts), len(batches))
+
+        # Старые чанки переиндексируемых источников удаляем: id могли поменяться
+        # (другая схема id, файл стал короче)
+        self.collection.delete(where={"source": {"$in": list(changed)}})
         self.collection.upsert(
             ids=all_ids,
             embeddings=all_embeddings,
@@ -189,11 +405,17 @@ class RAGStore:
             metadatas=all_metadatas,
         )
 
-        logger.info("Проиндексировано %d чанков из %d файлов", len(all_ids), len(source_counts))
+        # Без манифеста переиндексированы все файлы — теперь он полный
+        self._update_manifest(changed)
+
+        logger.info("Проиндексировано %d чанков из %d файлов", len(all_ids), len(changed))
         return source_counts
 
     def list_sources(self) -> list[str]:
         """Возвращает список уникальных источников в коллекции."""
+        if self._has_manifest:
+            with _MANIFEST_LOCK:
+                return sorted(self._manifest)
         try:
             res = self.collection.get(include=["metadatas"])
             if not res or not res.get("metadatas"):
@@ -223,14 +445,17 @@ class RAGStore:
                 f"Источник '{source}' не найден. Используйте /rag_list для списка."
             )
 
+        # Нужны только ids — метаданные и документы не запрашиваем
         res = self.collection.get(
             where={"source": source},
-            include=["metadatas"],
+            include=[],
         )
         ids_to_delete = res.get("ids", [])
         if ids_to_delete:
             self.collection.delete(ids=ids_to_delete)
         count = len(ids_to_delete)
+        if self._has_manifest and source in self._manifest:
+            self._update_manifest(removed=[source])
 
         data_dir = Path(data_dir or DATA_DIR)
         file_path = (data_dir / source).resolve()
@@ -251,7 +476,9 @@ class RAGStore:
         """
         Поиск по хранилищу. Возвращает [(document, source, distance), ...]
         """
-        query_embedding = get_embedding(self.client, query_text)
+        # Регистр и пробелы на смысл запроса почти не влияют — нормализуем ключ кэша
+        normalized = " ".join(query_text.lower().split())
+        query_embedding = list(self._query_embedding(normalized))
         res = self.collection.query(
             query_embeddings=[query_embedding],
             n_results=n_results,
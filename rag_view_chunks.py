@@ -13,6 +13,8 @@ import argparse
 import sys
 from pathlib import Path
 
+PAGE_SIZE = 1000  # записей за один запрос к ChromaDB
+
 
 def get_collection(persist_dir: Path):
     """Подключается к ChromaDB и возвращает коллекцию."""
@@ -39,6 +41,22 @@ def get_collection(persist_dir: Path):
     )
 
 
+def iter_pages(collection, where: dict | None, include: list[str], page_size: int = PAGE_SIZE):
+    """Читает коллекцию страницами: (ids, documents, metadatas) по page_size записей."""
+    offset = 0
+    while True:
+        res = collection.get(where=where, include=include, limit=page_size, offset=offset)
+        ids = res.get("ids") or []
+        if not ids:
+            return
+        docs = res.get("documents") or [""] * len(ids)
+        metas = res.get("metadatas") or [{}] * len(ids)
+        yield ids, docs, metas
+        if len(ids) < page_size:
+            return
+        offset += len(ids)
+
+
 def main():
     parser = argparse.ArgumentParser(
         description="Просмотр чанков RAG-хранилища ChromaDB"
@@ -68,47 +86,48 @@ def main():
     args = parser.parse_args()
 
     collection = get_collection(args.path)
+    where = {"source": args.source} if args.source else None
+
+    # Первый проход — только метаданные: источники и число чанков
+    counts: dict[str, int] = {}
+    for _, _, metas in iter_pages(collection, where, include=["metadatas"]):
+        for m in metas:
+            s = (m or {}).get("source", "?")
+            counts[s] = counts.get(s, 0) + 1
+    total = sum(counts.values())
 
-    if args.source:
-        res = collection.get(
-            where={"source": args.source},
-            include=["documents", "metadatas"],
-        )
-    else:
-        res = collection.get(
-            include=["documents", "metadatas"],
-        )
-
-    ids = res.get("ids", [])
-    docs = res.get("documents", [])
-    metas = res.get("metadatas", []) or [{}] * len(ids)
-
-    if not ids:
+    if not total:
         print("Хранилище пусто или источник не найден.")
         return
 
-    sources = sorted({m.get("source", "?") for m in metas if m})
+    sources = sorted(counts)
     print(f"Источники: {', '.join(sources)}\n")
 
     if args.list:
         for s in sources:
-            count = sum(1 for m in metas if m and m.get("source") == s)
-            print(f"  • {s}: {count} чанков")
+            print(f"  • {s}: {counts[s]} чанков")
         return
 
+    # Второй проход — документы страницами, печатаем по мере получения
     print("=" * 60)
-    for i, (doc_id, doc_text, meta) in enumerate(zip(ids, docs, metas)):
-        if args.limit and i >= args.limit:
-            print(f"\n... показано {args.limit} из {len(ids)} чанков")
+    shown = 0
+    for ids, docs, metas in iter_pages(collection, where, include=["documents", "metadatas"]):
+        for doc_id, doc_text, meta in zip(ids, docs, metas):
+            if args.limit and shown >= args.limit:
+                break
+            source = (meta or {}).get("source", "?")
+            print(f"\n[{doc_id}] {source}")
+            print("-" * 40)
+            print(doc_text[:500] + "..." if len(doc_text) > 500 else doc_text)
+            print()
+            shown += 1
+        if args.limit and shown >= args.limit:
+            if shown < total:
+                print(f"\n... показано {args.limit} из {total} чанков")
             break
-        source = meta.get("source", "?")
-        print(f"\n[{doc_id}] {source}")
-        print("-" * 40)
-        print(doc_text[:500] + "..." if len(doc_text) > 500 else doc_text)
-        print()
 
     print("=" * 60)
-    print(f"Всего чанков: {len(ids)}")
+    print(f"Всего чанков: {total}")
 
 
 if __name__ == "__main__":